@@ -8,6 +8,7 @@ Permite visualizar e gerenciar saques, verificar lucros e outras tarefas.
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import logging
+import math
 import config
 import database
 import pay
@@ -34,7 +35,7 @@ def register_admin_handlers(bot_instance):
 
     def is_admin(user_id):
         """Verifica se um ID de usuário pertence a um administrador."""
-        return user_id in config.ADMIN_TELEGRAM_IDS
+        return user_id in config.ADMIN_TELEGRAM_IDS_SET
 
     @bot.message_handler(commands=['admin', 'adm'])
     def handle_admin_command(message):
@@ -61,7 +62,7 @@ def register_admin_handlers(bot_instance):
             profit_message = (
                 f"📈 *Lucro Total com Taxas*\n\n"
                 f"O lucro total acumulado com taxas de depósito e saque é de:\n\n"
-                f"💰 *R$ {total_profit:.2f}*"
+                f"💰 *R$ {total_profit / 100:.2f}*"
             )
             
             markup = InlineKeyboardMarkup()
@@ -117,7 +118,7 @@ def register_admin_handlers(bot_instance):
             message_text += (
                 f"\n👤 *{user['first_name']}* {username}\n"
                 f"   - ID: `{user['telegram_id']}`\n"
-                f"   - Saldo: *R$ {user['balance']:.2f}*\n"
+                f"   - Saldo: *R$ {user['balance_cents'] / 100:.2f}*\n"
             )
         
         try:
@@ -156,10 +157,12 @@ def register_admin_handlers(bot_instance):
             bot.reply_to(message, f"❌ Usuário com ID `{target_user_id}` não encontrado. Verifique o ID.")
             return
 
+        # O saldo é lido direto do banco: get_user_info vem de cache e não o inclui
+        saldo_atual_cents = database.get_balance(target_user_id)
         msg = bot.reply_to(
             message,
             f"✅ Usuário `{target_user_id}` (`{user_info.get('first_name', 'N/A')}`) encontrado.\n"
-            f"💰 Saldo atual: *R$ {user_info.get('balance', 0.00):.2f}*\n\n"
+            f"💰 Saldo atual: *R$ {saldo_atual_cents / 100:.2f}*\n\n"
             "Envie o *novo saldo* a ser definido (ex: `150.75`).",
             parse_mode="Markdown"
         )
@@ -172,21 +175,24 @@ def register_admin_handlers(bot_instance):
         
         try:
             new_balance = float(message.text.replace(',', '.'))
+            if not math.isfinite(new_balance):
+                raise ValueError("saldo não finito")
             if new_balance < 0:
                 bot.reply_to(message, "❌ O saldo não pode ser negativo. Operação cancelada.")
                 return
+            new_balance_cents = round(new_balance * 100)
         except (ValueError, TypeError):
             bot.reply_to(message, "❌ Valor inválido. Envie um número (ex: `25.50`). Operação cancelada.")
             return
 
-        logger.info(f"👑 Admin {admin_id} está definindo o saldo do usuário {target_user_id} para R${new_balance:.2f}.")
+        logger.warning(f"👑 Admin {admin_id} está definindo o saldo do usuário {target_user_id} para R${new_balance_cents / 100:.2f}.")
         
-        if database.admin_set_balance(target_user_id, new_balance):
-            bot.reply_to(message, f"✅ Sucesso! O saldo de `{target_user_id}` foi definido para *R$ {new_balance:.2f}*.", parse_mode="Markdown")
-            logger.info(f"✅ Saldo de {target_user_id} definido para R${new_balance:.2f} por {admin_id}.")
+        if database.admin_set_balance(target_user_id, new_balance_cents):
+            bot.reply_to(message, f"✅ Sucesso! O saldo de `{target_user_id}` foi definido para *R$ {new_balance_cents / 100:.2f}*.", parse_mode="Markdown")
+            logger.warning(f"✅ Saldo de {target_user_id} definido para R${new_balance_cents / 100:.2f} por {admin_id}.")
             
             try:
-                bot.send_message(target_user_id, f"ℹ️ *Aviso Administrativo:*\nSeu saldo foi ajustado para *R$ {new_balance:.2f}*.", parse_mode="Markdown")
+                bot.send_message(target_user_id, f"ℹ️ *Aviso Administrativo:*\nSeu saldo foi ajustado para *R$ {new_balance_cents / 100:.2f}*.", parse_mode="Markdown")
             except Exception as e:
                 logger.warning(f"Não foi possível notificar {target_user_id} sobre a alteração de saldo: {e}")
         else:
@@ -216,10 +222,11 @@ def register_admin_handlers(bot_instance):
             return
         
         user_telegram_id = transaction['user_telegram_id']
-        original_amount = transaction['amount']
+        original_amount_cents = transaction['amount_cents']
+        original_amount = original_amount_cents / 100
 
         if action == "approve":
-            logger.info(f"👑 Admin {admin_id} iniciou APROVAÇÃO do saque {transaction_id} no valor de R${original_amount:.2f}.")
+            logger.warning(f"👑 Admin {admin_id} iniciou APROVAÇÃO do saque {transaction_id} no valor de R${original_amount:.2f}.")
             bot.answer_callback_query(call.id, "⏳ Processando pagamento...")
             bot.edit_message_text(f"⏳ Processando pagamento para saque ID `{transaction_id}` (R${original_amount:.2f})...", call.message.chat.id, call.message.message_id, reply_markup=None)
             database.update_transaction_status(transaction_id, config.STATUS_EM_ANDAMENTO)
@@ -236,15 +243,15 @@ def register_admin_handlers(bot_instance):
                 database.update_transaction_status(transaction_id, config.STATUS_CONCLUIDO, mp_id=payout_id)
                 bot.send_message(user_telegram_id, f"✅ Seu saque de R${original_amount:.2f} foi *APROVADO* e o pagamento foi enviado!\nID da transação: `{transaction_id}`")
                 bot.edit_message_text(f"✅ Saque ID `{transaction_id}` (R${original_amount:.2f}) *APROVADO E PAGO*.\nID do Gateway: `{payout_id}`", call.message.chat.id, call.message.message_id)
-                logger.info(f"✅ Saque {transaction_id} APROVADO e pago pelo admin {admin_id}.")
+                logger.warning(f"✅ Saque {transaction_id} APROVADO e pago pelo admin {admin_id}.")
             else:
                 error_msg = payout_result.get('message', 'Erro desconhecido')
                 database.update_transaction_status(transaction_id, config.STATUS_FALHA_PAGAMENTO, admin_notes=f"Admin {admin_id} tentou aprovar. Gateway: {error_msg}")
-                fee_amount = database.get_fee_for_withdrawal(transaction_id)
-                total_to_refund = original_amount + fee_amount
+                fee_amount_cents = database.get_fee_for_withdrawal(transaction_id)
+                total_to_refund_cents = original_amount_cents + fee_amount_cents
                 
-                if database.update_balance(user_telegram_id, total_to_refund):
-                    bot.send_message(user_telegram_id, f"⚠️ *Atenção:* Ocorreu uma falha no envio do seu saque de R${original_amount:.2f} (ID: `{transaction_id}`). O valor total de *R${total_to_refund:.2f}* foi estornado ao seu saldo. Por favor, tente novamente mais tarde ou contate o suporte.")
+                if database.update_balance(user_telegram_id, total_to_refund_cents):
+                    bot.send_message(user_telegram_id, f"⚠️ *Atenção:* Ocorreu uma falha no envio do seu saque de R${original_amount:.2f} (ID: `{transaction_id}`). O valor total de *R${total_to_refund_cents / 100:.2f}* foi estornado ao seu saldo. Por favor, tente novamente mais tarde ou contate o suporte.")
                     bot.edit_message_text(f"❌ *FALHA NO PAGAMENTO* para saque ID `{transaction_id}`.\nMotivo: {error_msg}\n\n*O valor total (saque + taxa) foi estornado ao saldo do usuário.*", call.message.chat.id, call.message.message_id)
                     logger.error(f"❌ Falha no pagamento do saque {transaction_id} (Admin: {admin_id}). Valor estornado ao usuário.")
                 else:
@@ -252,17 +259,17 @@ def register_admin_handlers(bot_instance):
                     bot.edit_message_text(f"🆘 *CRÍTICO:* Falha no pagamento para saque ID `{transaction_id}` E *FALHA AO ESTORNAR O SALDO*. Contate o suporte técnico imediatamente!", call.message.chat.id, call.message.message_id)
 
         elif action == "reject":
-            logger.info(f"👑 Admin {admin_id} iniciou REJEIÇÃO do saque {transaction_id}.")
+            logger.warning(f"👑 Admin {admin_id} iniciou REJEIÇÃO do saque {transaction_id}.")
             bot.answer_callback_query(call.id, "🚫 Rejeitando e estornando valor...")
-            fee_amount = database.get_fee_for_withdrawal(transaction_id)
-            total_to_refund = original_amount + fee_amount
+            fee_amount_cents = database.get_fee_for_withdrawal(transaction_id)
+            total_to_refund_cents = original_amount_cents + fee_amount_cents
             
-            if database.update_balance(user_telegram_id, total_to_refund):
+            if database.update_balance(user_telegram_id, total_to_refund_cents):
                 admin_notes = f"Rejeitado pelo administrador {admin_id}."
                 database.update_transaction_status(transaction_id, config.STATUS_RECUSADO, admin_notes=admin_notes)
-                bot.edit_message_text(f"🚫 Saque ID `{transaction_id}` *RECUSADO*. O valor de R$ {total_to_refund:.2f} foi estornado com sucesso ao usuário.", call.message.chat.id, call.message.message_id, reply_markup=None)
-                bot.send_message(user_telegram_id, f"❌ Sua solicitação de saque de R${original_amount:.2f} (ID: `{transaction_id}`) foi *RECUSADA*. O valor total debitado de R${total_to_refund:.2f} foi devolvido integralmente ao seu saldo.")
-                logger.info(f"🚫 Saque {transaction_id} REJEITADO pelo admin {admin_id}. Valor estornado.")
+                bot.edit_message_text(f"🚫 Saque ID `{transaction_id}` *RECUSADO*. O valor de R$ {total_to_refund_cents / 100:.2f} foi estornado com sucesso ao usuário.", call.message.chat.id, call.message.message_id, reply_markup=None)
+                bot.send_message(user_telegram_id, f"❌ Sua solicitação de saque de R${original_amount:.2f} (ID: `{transaction_id}`) foi *RECUSADA*. O valor total debitado de R${total_to_refund_cents / 100:.2f} foi devolvido integralmente ao seu saldo.")
+                logger.warning(f"🚫 Saque {transaction_id} REJEITADO pelo admin {admin_id}. Valor estornado.")
             else:
                 logger.critical(f"🆘 CRÍTICO: FALHA AO ESTORNAR saldo para o saque rejeitado {transaction_id} (Admin: {admin_id}). INTERVENÇÃO MANUAL URGENTE!")
                 bot.edit_message_text(f"🆘 *CRÍTICO:* Saque ID `{transaction_id}` rejeitado, MAS FALHOU AO ESTORNAR O SALDO. Contate o suporte técnico imediatamente!", call.message.chat.id, call.message.message_id)
@@ -5,11 +5,16 @@
 Este arquivo contém todas as variáveis, chaves de API, textos e parâmetros
 que controlam o comportamento do bot. Mantenha as chaves secretas no arquivo .env.
 """
+import functools
+import logging
 import os
 from dotenv import load_dotenv
 
-# Carrega as variáveis de ambiente do arquivo .env
-load_dotenv()
+# Carrega as variáveis de ambiente do arquivo .env (apenas uma vez por processo,
+# mesmo que o módulo seja recarregado).
+if not globals().get("_DOTENV_LOADED"):
+    load_dotenv()
+    _DOTENV_LOADED = True
 
 # =============================================
 # 🔑 CHAVES DE API E CONFIGURAÇÕES CRÍTICAS
@@ -24,23 +29,55 @@ MERCADOPAGO_ACCESS_TOKEN = os.getenv("MERCADOPAGO_ACCESS_TOKEN")
 # URL de conexão do banco de dados PostgreSQL, fornecida pela Railway.
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Tamanho do pool de conexões com o PostgreSQL (mínimo e máximo de conexões abertas).
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# Idade máxima (em segundos) de uma conexão do pool antes de ser descartada e reaberta,
+# para não reutilizar conexões ociosas já derrubadas pela Railway/PgBouncer. 0 (ou negativo) desativa.
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+# Modo de pooling do PgBouncer à frente do banco ("transaction", "session" ou vazio se
+# não houver PgBouncer). Em "transaction" cada transação pode cair em outra conexão do
+# servidor, então o bot não usa estado de sessão (como statements preparados).
+# O padrão é vazio (conexão direta, como no deploy da Railway), mantendo o PREPARE/EXECUTE;
+# defina "transaction" apenas quando houver um PgBouncer nesse modo.
+PGBOUNCER_MODE = os.getenv("PGBOUNCER_MODE", "").lower()
+
 # Define se o bot está em modo de produção. Afeta logs e avisos.
 # Defina como "true" no seu ambiente de produção.
 PRODUCTION = os.getenv("PRODUCTION", "False").lower() == "true"
+IS_PRODUCTION = PRODUCTION
+
+# Nível mínimo de log. Em produção o padrão é WARNING, para que chamadas INFO sejam
+# descartadas logo no início, sem nem formatar seus argumentos. Ex: "DEBUG", "INFO".
+# Os registros de auditoria de movimentações de dinheiro usam WARNING e continuam visíveis.
+_LOG_LEVEL_PADRAO = "WARNING" if PRODUCTION else "INFO"
+LOG_LEVEL = os.getenv("LOG_LEVEL", _LOG_LEVEL_PADRAO).upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    print(f"⚠️ ERRO: LOG_LEVEL '{LOG_LEVEL}' inválido. Usando '{_LOG_LEVEL_PADRAO}'.")
+    LOG_LEVEL = _LOG_LEVEL_PADRAO
 
 
 # =============================================
 # 👑 ADMINISTRADORES DO BOT
 # =============================================
 # Lista de IDs de usuários do Telegram que terão acesso aos comandos administrativos.
-ADMIN_TELEGRAM_IDS = []
+# O parser é definido uma única vez por processo, como o load_dotenv acima, para que
+# um reload do módulo reaproveite o resultado já em cache em vez de refazer o split.
+if "_parse_admins" not in globals():
+    @functools.lru_cache(maxsize=1)
+    def _parse_admins(s: str) -> frozenset[int]:
+        """Converte a string de IDs separados por vírgula, ignorando entradas vazias."""
+        return frozenset(int(x.strip()) for x in s.split(',') if x.strip())
+
 admin_ids_str = os.getenv("ADMIN_TELEGRAM_IDS", "") # Ex: "123456,789012"
-if admin_ids_str:
-    try:
-        # Converte a string de IDs separados por vírgula em uma lista de inteiros
-        ADMIN_TELEGRAM_IDS = [int(admin_id.strip()) for admin_id in admin_ids_str.split(',')]
-    except ValueError:
-        print("⚠️ ERRO: ADMIN_TELEGRAM_IDS no arquivo .env contém um valor inválido. Use números inteiros separados por vírgula.")
+try:
+    # Conjunto imutável dos IDs, para verificações de permissão em O(1)
+    ADMIN_TELEGRAM_IDS_SET = _parse_admins(admin_ids_str)
+except ValueError:
+    ADMIN_TELEGRAM_IDS_SET = frozenset()
+    print("⚠️ ERRO: ADMIN_TELEGRAM_IDS no arquivo .env contém um valor inválido. Use números inteiros separados por vírgula.")
+ADMIN_TELEGRAM_IDS = list(ADMIN_TELEGRAM_IDS_SET)
 
 
 # =============================================
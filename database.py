@@ -6,25 +6,135 @@ Responsável por todas as interações com o banco de dados PostgreSQL.
 Inclui criação de tabelas, CRUD de usuários e transações.
 """
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2 import pool
+from psycopg2.extras import DictCursor, execute_values
+from cachetools import TTLCache
 import logging
-from datetime import datetime, timedelta # <<< Adicionado timedelta
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 import config
-import decimal # <<< 1. IMPORT ADDED
 
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
+# Todos os valores monetários são guardados e trafegam como centavos inteiros
+# (colunas BIGINT *_cents); a conversão para reais acontece só na exibição.
+
+# Consultas mais frequentes do bot, preparadas no servidor (PREPARE) uma única vez
+# por conexão. Formato: nome -> (tipos dos parâmetros, SQL com $1, $2...).
+_PREPARED_STATEMENTS = {
+    'get_balance_stmt': ('bigint', "SELECT balance_cents FROM users WHERE telegram_id = $1"),
+    'get_user_info_stmt': ('bigint', "SELECT telegram_id, username, first_name FROM users WHERE telegram_id = $1"),
+    'get_wallet_summary_stmt': (
+        'bigint',
+        "SELECT u.balance_cents, (SELECT t.updated_at FROM transactions t WHERE t.user_telegram_id = u.telegram_id "
+        "ORDER BY t.updated_at DESC LIMIT 1) FROM users u WHERE u.telegram_id = $1"
+    ),
+}
+
+# Cursor simples do psycopg2 (linhas como tuplas), usado nas consultas de uma
+# única coluna, em que o acesso por nome do DictCursor não compensa o custo.
+_TupleCursor = psycopg2.extensions.cursor
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """
+    Conexão do pool: usa DictCursor por padrão (acesso às colunas por nome),
+    guarda quais statements já foram preparados nela e quando foi aberta.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = DictCursor
+        self.prepared_statements = set()
+        self.created_at = time.monotonic()
+
+    def is_reusable(self):
+        """Indica se a conexão pode voltar a ser usada (aberta, íntegra e dentro de DB_POOL_RECYCLE)."""
+        if self.closed or self.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        return config.DB_POOL_RECYCLE <= 0 or time.monotonic() - self.created_at < config.DB_POOL_RECYCLE
+
+# Statements preparados são estado de sessão e não sobrevivem ao pooling por transação
+# do PgBouncer; nesse modo as mesmas consultas são enviadas diretamente.
+_USE_PREPARED_STATEMENTS = config.PGBOUNCER_MODE != "transaction"
+
+# As mesmas consultas com placeholders %s, montadas uma única vez para o modo sem PREPARE.
+# Cada $n aparece uma única vez e em ordem nas consultas acima.
+_PLAIN_STATEMENTS = {
+    name: re.sub(r'\$\d+', '%s', sql) for name, (_, sql) in _PREPARED_STATEMENTS.items()
+}
+
+def _execute_prepared(cursor, name, params):
+    """
+    Executa um statement de _PREPARED_STATEMENTS via EXECUTE, evitando que o
+    PostgreSQL refaça parse e planejamento da consulta a cada chamada.
+    O PREPARE é feito na primeira vez que a conexão usa o statement.
+    Com PgBouncer em modo "transaction", executa a consulta sem preparar.
     """
-    Cria e retorna uma nova conexão com o banco de dados PostgreSQL.
-    Configura o DictCursor para permitir acesso às colunas por nome.
+    if not _USE_PREPARED_STATEMENTS:
+        cursor.execute(_PLAIN_STATEMENTS[name], params)
+        return
+
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        param_types, sql = _PREPARED_STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({param_types}) AS {sql}")
+        conn.prepared_statements.add(name)
+    placeholders = ', '.join(['%s'] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+# Pool de conexões compartilhado pelo processo inteiro, criado sob demanda.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool():
     """
+    Retorna o pool de conexões do processo, criando-o na primeira chamada.
+    Evita o custo de abrir uma nova conexão (TCP + TLS + autenticação) a cada consulta.
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                try:
+                    _POOL = pool.ThreadedConnectionPool(
+                        minconn=config.DB_POOL_MIN,
+                        maxconn=config.DB_POOL_MAX,
+                        dsn=config.DATABASE_URL,
+                        connection_factory=_PooledConnection,
+                        application_name=config.NOME_BOT.lower()
+                    )
+                    logger.info("🔌 Pool de conexões criado (min=%s, max=%s).", config.DB_POOL_MIN, config.DB_POOL_MAX)
+                except psycopg2.OperationalError as e:
+                    logger.critical("FATAL: Não foi possível conectar ao banco de dados PostgreSQL: %s", e, exc_info=True)
+                    raise
+    return _POOL
+
+@contextmanager
+def db_conn():
+    """
+    Empresta uma conexão do pool e a devolve ao final do bloco `with`.
+    Transações não finalizadas (sem commit) são desfeitas pelo pool na devolução.
+    Conexões quebradas ou mais velhas que DB_POOL_RECYCLE são fechadas em vez de
+    reutilizadas, e o pool abre uma nova no lugar.
+    """
+    db_pool = _get_pool()
+    conn = db_pool.getconn()
+    while not conn.is_reusable():
+        logger.info("♻️ Descartando conexão do pool expirada ou quebrada.")
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
     try:
-        conn = psycopg2.connect(config.DATABASE_URL)
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.critical(f"FATAL: Não foi possível conectar ao banco de dados PostgreSQL: {e}", exc_info=True)
-        raise
+        yield conn
+    finally:
+        db_pool.putconn(conn, close=not conn.is_reusable())
+
+def _borrow_conn(conn_ext=None):
+    """
+    Contexto para as funções que aceitam conn_ext: usa a conexão externa sem
+    devolvê-la ao pool, ou empresta uma nova via db_conn().
+    """
+    return nullcontext(conn_ext) if conn_ext is not None else db_conn()
 
 # Em database.py
 
@@ -32,7 +142,7 @@ def init_db():
     """
     Inicializa o banco de dados, criando as tabelas se não existirem.
     """
-    with get_db_connection() as conn:
+    with db_conn() as conn:
         with conn.cursor() as cursor:
             # Tabela de Usuários
             cursor.execute('''
@@ -40,8 +150,8 @@ def init_db():
                     telegram_id BIGINT PRIMARY KEY,
                     username TEXT,
                     first_name TEXT,
-                    balance NUMERIC(15, 2) DEFAULT 0.00,  -- <<< ALTERADO DE REAL PARA NUMERIC
-                    created_at TIMESTAMPTZ NOT NULL
+                    balance_cents BIGINT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 )
             ''')
             # Tabela de Transações
@@ -50,312 +160,468 @@ def init_db():
                     id SERIAL PRIMARY KEY,
                     user_telegram_id BIGINT NOT NULL,
                     type TEXT NOT NULL,
-                    amount NUMERIC(15, 2) NOT NULL,        -- <<< ALTERADO DE REAL PARA NUMERIC
+                    amount_cents BIGINT NOT NULL,
                     status TEXT NOT NULL,
                     pix_key TEXT,
                     mercado_pago_id TEXT,
                     admin_notes TEXT,
-                    created_at TIMESTAMPTZ NOT NULL,
-                    updated_at TIMESTAMPTZ NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    parent_transaction_id INTEGER REFERENCES transactions (id),
                     FOREIGN KEY (user_telegram_id) REFERENCES users (telegram_id)
                 )
             ''')
+            # Migração: valores em centavos inteiros (BIGINT) no lugar das antigas colunas
+            # NUMERIC em reais (users.balance, transactions.amount e profits.total).
+            cursor.execute('''
+                DO $$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                               AND table_name = 'users' AND column_name = 'balance') THEN
+                        ALTER TABLE users RENAME COLUMN balance TO balance_cents;
+                        ALTER TABLE users
+                            ALTER COLUMN balance_cents TYPE BIGINT USING COALESCE(round(balance_cents * 100), 0),
+                            ALTER COLUMN balance_cents SET DEFAULT 0,
+                            ALTER COLUMN balance_cents SET NOT NULL;
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                               AND table_name = 'transactions' AND column_name = 'amount') THEN
+                        ALTER TABLE transactions RENAME COLUMN amount TO amount_cents;
+                        ALTER TABLE transactions ALTER COLUMN amount_cents TYPE BIGINT USING round(amount_cents * 100);
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                               AND table_name = 'profits' AND column_name = 'total') THEN
+                        ALTER TABLE profits RENAME COLUMN total TO total_cents;
+                        ALTER TABLE profits ALTER COLUMN total_cents TYPE BIGINT USING round(total_cents * 100);
+                    END IF;
+                END
+                $$
+            ''')
+            # Migração: datas preenchidas pelo próprio PostgreSQL em tabelas já existentes
+            cursor.execute("ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now()")
+            cursor.execute("ALTER TABLE transactions ALTER COLUMN created_at SET DEFAULT now(), ALTER COLUMN updated_at SET DEFAULT now()")
+            # Migração: vincula cada taxa (FEE) à transação que a originou, em vez de
+            # depender do texto de admin_notes para encontrá-la.
+            cursor.execute('''
+                ALTER TABLE transactions
+                ADD COLUMN IF NOT EXISTS parent_transaction_id INTEGER REFERENCES transactions (id)
+            ''')
+            cursor.execute('''
+                UPDATE transactions
+                SET parent_transaction_id = CAST(substring(admin_notes from '(\\d+)$') AS INTEGER)
+                WHERE type = 'FEE' AND parent_transaction_id IS NULL AND (
+                    admin_notes LIKE 'Taxa referente ao saque ID %'
+                    OR admin_notes LIKE 'Taxa de depósito referente à transação ID %'
+                )
+            ''')
+            # Índices para as consultas mais frequentes sobre transações
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_type_status ON transactions (type, status)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_updated ON transactions (user_telegram_id, updated_at DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_parent ON transactions (parent_transaction_id)")
+            # Lucro acumulado em uma única linha, para que calculate_profits não
+            # precise somar todas as taxas do histórico a cada consulta.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS profits (
+                    id INTEGER PRIMARY KEY DEFAULT 1,
+                    total_cents BIGINT NOT NULL DEFAULT 0
+                )
+            ''')
+            # Na primeira execução, parte do lucro já existente no histórico. Cada taxa aponta
+            # para a transação que a originou; taxas de saque só contam se o saque foi concluído.
+            cursor.execute('''
+                INSERT INTO profits (id, total_cents)
+                SELECT 1, COALESCE(SUM(T1.amount_cents), 0)
+                FROM transactions T1
+                JOIN transactions T2 ON T2.id = T1.parent_transaction_id
+                WHERE T1.type = 'FEE' AND T1.status = %(concluido)s AND (
+                    T2.type = 'DEPOSIT' OR (T2.type = 'WITHDRAWAL' AND T2.status = %(concluido)s)
+                )
+                ON CONFLICT (id) DO NOTHING
+            ''', {'concluido': config.STATUS_CONCLUIDO})
+            # A partir daí, o trigger mantém o total atualizado com as mesmas regras.
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION accumulate_profits() RETURNS TRIGGER AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        -- Taxas de depósito contam assim que são registradas.
+                        IF NEW.type = 'FEE' AND NEW.status = %(concluido)s AND EXISTS (
+                            SELECT 1 FROM transactions WHERE id = NEW.parent_transaction_id AND type = 'DEPOSIT'
+                        ) THEN
+                            UPDATE profits SET total_cents = total_cents + NEW.amount_cents WHERE id = 1;
+                        END IF;
+                    ELSIF NEW.type = 'WITHDRAWAL' AND NEW.status = %(concluido)s
+                          AND OLD.status IS DISTINCT FROM NEW.status THEN
+                        -- Taxas de saque contam quando o saque é concluído.
+                        UPDATE profits SET total_cents = total_cents + COALESCE((
+                            SELECT SUM(amount_cents) FROM transactions
+                            WHERE type = 'FEE' AND status = %(concluido)s AND parent_transaction_id = NEW.id
+                        ), 0) WHERE id = 1;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''', {'concluido': config.STATUS_CONCLUIDO})
+            cursor.execute("DROP TRIGGER IF EXISTS trg_accumulate_profits ON transactions")
+            cursor.execute('''
+                CREATE TRIGGER trg_accumulate_profits
+                AFTER INSERT OR UPDATE OF status ON transactions
+                FOR EACH ROW EXECUTE PROCEDURE accumulate_profits()
+            ''')
         conn.commit()
     logger.info("✅ Banco de dados PostgreSQL inicializado e verificado com sucesso.")
 
 # <<< NOVA FUNÇÃO >>>
 def get_pending_pix_transactions(hours=2):
     """Busca transações PIX pendentes das últimas 'hours' horas."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
-                time_threshold = datetime.now() - timedelta(hours=hours)
                 sql = """
                     SELECT * FROM transactions
-                    WHERE type = 'DEPOSIT' AND status = %s AND created_at >= %s
+                    WHERE type = 'DEPOSIT' AND status = %s AND created_at >= now() - make_interval(hours => %s)
                 """
-                cursor.execute(sql, (config.STATUS_DEPOSITO_PENDENTE, time_threshold))
+                cursor.execute(sql, (config.STATUS_DEPOSITO_PENDENTE, hours))
                 return cursor.fetchall()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar PIX pendentes: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar PIX pendentes: %s", e, exc_info=True)
                 return []
 
 # <<< NOVA FUNÇÃO >>>
 def get_transaction_by_id_and_user(transaction_id, user_telegram_id):
     """Busca uma transação pelo ID, garantindo que pertence ao usuário."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
                 cursor.execute("SELECT * FROM transactions WHERE id = %s AND user_telegram_id = %s", (transaction_id, user_telegram_id))
                 return cursor.fetchone()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar transação {transaction_id} para usuário {user_telegram_id}: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar transação %s para usuário %s: %s", transaction_id, user_telegram_id, e, exc_info=True)
                 return None
 
 # (O restante do arquivo database.py, com as outras funções, continua aqui sem alterações...)
-# (admin_set_balance, get_users_with_balance, create_user_if_not_exists, etc...)
-def admin_set_balance(user_telegram_id, new_balance):
-    """[ADMIN] Define um novo saldo para um usuário."""
-    with get_db_connection() as conn:
+# (admin_set_balance, get_users_with_balance, create_users_if_not_exist, etc...)
+def admin_set_balance(user_telegram_id, new_balance_cents):
+    """[ADMIN] Define um novo saldo (em centavos) para um usuário."""
+    with db_conn() as conn:
         try:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE users SET balance = %s WHERE telegram_id = %s",
-                    (new_balance, user_telegram_id)
-                )
-                if cursor.rowcount > 0:
-                    record_transaction(
-                        user_telegram_id=user_telegram_id, type='AJUSTE_MANUAL',
-                        amount=new_balance, status='CONCLUIDO',
-                        admin_notes=f"Saldo definido para R${new_balance:.2f} por um admin."
+            with conn.cursor(cursor_factory=_TupleCursor) as cursor:
+                # Novo saldo e registro do ajuste em uma única instrução (e um único commit).
+                cursor.execute("""
+                    WITH upd AS (
+                        UPDATE users SET balance_cents = %s WHERE telegram_id = %s
+                        RETURNING telegram_id, balance_cents
                     )
-                    conn.commit()
-                    return True
-                return False
+                    INSERT INTO transactions (user_telegram_id, type, amount_cents, status, admin_notes)
+                    SELECT telegram_id, 'AJUSTE_MANUAL', balance_cents, 'CONCLUIDO', %s FROM upd
+                    RETURNING id
+                """, (new_balance_cents, user_telegram_id, f"Saldo definido para R${new_balance_cents / 100:.2f} por um admin."))
+                result = cursor.fetchone()
+                if result is None:
+                    return False
+            conn.commit()
+            logger.info("📄 Transação %s (Tipo: AJUSTE_MANUAL) registrada para usuário %s.", result[0], user_telegram_id)
+            return True
         except psycopg2.Error as e:
-            logger.error(f"❌ Erro no DB ao setar saldo para {user_telegram_id}: {e}", exc_info=True)
+            logger.error("❌ Erro no DB ao setar saldo para %s: %s", user_telegram_id, e, exc_info=True)
             conn.rollback()
             return False
 
 def get_users_with_balance():
     """[ADMIN] Retorna todos os usuários com saldo maior que zero."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
-                cursor.execute("SELECT telegram_id, first_name, username, balance FROM users WHERE balance > 0 ORDER BY balance DESC")
+                cursor.execute("SELECT telegram_id, first_name, username, balance_cents FROM users WHERE balance_cents > 0 ORDER BY balance_cents DESC")
                 return cursor.fetchall()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar usuários com saldo: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar usuários com saldo: %s", e, exc_info=True)
                 return []
 
-def create_user_if_not_exists(telegram_id, username, first_name):
-    """Cria um novo usuário se ele não existir."""
-    now = datetime.now()
-    with get_db_connection() as conn:
+def create_users_if_not_exist(rows):
+    """
+    Cria, em uma única instrução e um único commit, todos os usuários de um lote
+    que ainda não existem (ex: os autores de um lote de updates do Telegram).
+
+    Args:
+        rows (list): Tuplas (telegram_id, username, first_name).
+    """
+    if not rows:
+        return
+    with db_conn() as conn:
         try:
             with conn.cursor() as cursor:
-                sql = """
-                    INSERT INTO users (telegram_id, username, first_name, balance, created_at)
-                    VALUES (%s, %s, %s, 0.00, %s)
-                    ON CONFLICT (telegram_id) DO NOTHING;
-                """
-                cursor.execute(sql, (telegram_id, username, first_name, now))
-                if cursor.rowcount > 0:
-                    logger.info(f"👤 Novo usuário criado: ID={telegram_id}, Nome='{first_name}'.")
+                execute_values(
+                    cursor,
+                    "INSERT INTO users (telegram_id, username, first_name) VALUES %s "
+                    "ON CONFLICT (telegram_id) DO NOTHING",
+                    rows, page_size=500
+                )
             conn.commit()
         except psycopg2.Error as e:
-            logger.error(f"❌ Erro ao tentar criar usuário {telegram_id}: {e}", exc_info=True)
+            logger.error("❌ Erro ao tentar criar %s usuários em lote: %s", len(rows), e, exc_info=True)
             conn.rollback()
 
 def get_balance(telegram_id):
-    """Busca e retorna o saldo de um usuário."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    """Busca e retorna o saldo de um usuário, em centavos."""
+    with db_conn() as conn:
+        with conn.cursor(cursor_factory=_TupleCursor) as cursor:
             try:
-                cursor.execute("SELECT balance FROM users WHERE telegram_id = %s", (telegram_id,))
+                _execute_prepared(cursor, 'get_balance_stmt', (telegram_id,))
                 result = cursor.fetchone()
-                return result['balance'] if result else 0.00
+                return result[0] if result else 0
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar saldo para {telegram_id}: {e}", exc_info=True)
-                return 0.00
+                logger.error("❌ Erro ao buscar saldo para %s: %s", telegram_id, e, exc_info=True)
+                return 0
 
-def update_balance(telegram_id, amount_change, conn_ext=None):
-    """Atualiza o saldo de um usuário."""
-    conn = conn_ext or get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("SELECT balance FROM users WHERE telegram_id = %s FOR UPDATE", (telegram_id,))
-            result = cursor.fetchone()
-            
-            # <<< 2. MODIFIED BLOCK START >>>
-            current_balance = result['balance'] if result else decimal.Decimal('0.00')
-            
-            # Convert float to Decimal for safe addition/subtraction
-            decimal_amount_change = decimal.Decimal(str(amount_change))
-            new_balance = current_balance + decimal_amount_change
-            
-            if new_balance < 0:
-                logger.warning(f"⚠️ Tentativa de deixar saldo negativo para {telegram_id}.")
-                # Do not rollback here, just signal failure
-                return False
-            # <<< MODIFIED BLOCK END >>>
-
-            cursor.execute("UPDATE users SET balance = %s WHERE telegram_id = %s", (new_balance, telegram_id))
-            if not conn_ext: conn.commit()
-            logger.info(f"💰 Saldo de {telegram_id} atualizado. De R${current_balance:.2f} para R${new_balance:.2f} (Mudança: {amount_change:+.2f}).")
-            return True
-    except psycopg2.Error as e:
-        logger.error(f"❌ Erro ao atualizar saldo para {telegram_id}: {e}", exc_info=True)
-        if conn_ext is None and conn: conn.rollback()
-        return False
-    finally:
-        if conn_ext is None and conn: conn.close()
+def update_balance(telegram_id, change_cents, conn_ext=None):
+    """
+    Soma `change_cents` (negativo para débitos) ao saldo de um usuário.
+    Quando a mudança vem acompanhada de uma nova transação, use apply_balance_change.
+    """
+    with _borrow_conn(conn_ext) as conn:
+        try:
+            with conn.cursor(cursor_factory=_TupleCursor) as cursor:
+                # Um único UPDATE trava a linha, valida e aplica a mudança: se o saldo
+                # ficaria negativo, nenhuma linha é retornada.
+                cursor.execute(
+                    "UPDATE users SET balance_cents = balance_cents + %s WHERE telegram_id = %s AND balance_cents + %s >= 0 RETURNING balance_cents",
+                    (change_cents, telegram_id, change_cents)
+                )
+                result = cursor.fetchone()
+                if result is None:
+                    logger.warning("⚠️ Tentativa de deixar saldo negativo (ou usuário inexistente) para %s.", telegram_id)
+                    # Do not rollback here, just signal failure
+                    return False
+
+                if not conn_ext: conn.commit()
+                logger.info("💰 Saldo de %s atualizado para %s centavos (Mudança: %+d).", telegram_id, result[0], change_cents)
+                return True
+        except psycopg2.Error as e:
+            logger.error("❌ Erro ao atualizar saldo para %s: %s", telegram_id, e, exc_info=True)
+            if conn_ext is None and not conn.closed: conn.rollback()
+            return False
+
+def apply_balance_change(telegram_id, change_cents, tx_kwargs, conn_ext=None):
+    """
+    Altera o saldo de um usuário e registra a transação correspondente em uma
+    única ida ao banco (UPDATE + INSERT na mesma instrução, via CTE).
+    Prefira esta função ao par update_balance + record_transaction.
+
+    Args:
+        telegram_id (int): O ID do usuário.
+        change_cents (int): Centavos a somar ao saldo (negativo para débitos).
+        tx_kwargs (dict): Campos da transação (type, amount_cents, status e, opcionalmente,
+                          pix_key, mercado_pago_id, admin_notes, parent_transaction_id).
+        conn_ext: Conexão externa; se informada, o commit fica a cargo do chamador.
+
+    Returns:
+        tuple: (id da transação, novo saldo em centavos), ou None se o saldo ficaria negativo,
+               se o usuário não existe ou em caso de erro.
+    """
+    params = {
+        'pix_key': None, 'mercado_pago_id': None, 'admin_notes': None, 'parent_transaction_id': None,
+        **tx_kwargs,
+        'user_telegram_id': telegram_id, 'change_cents': change_cents
+    }
+    with _borrow_conn(conn_ext) as conn:
+        try:
+            with conn.cursor(cursor_factory=_TupleCursor) as cursor:
+                # O saldo negativo é barrado pelo próprio WHERE: se o UPDATE não casar
+                # nenhuma linha, o INSERT também não acontece.
+                cursor.execute("""
+                    WITH upd AS (
+                        UPDATE users SET balance_cents = balance_cents + %(change_cents)s
+                        WHERE telegram_id = %(user_telegram_id)s AND balance_cents + %(change_cents)s >= 0
+                        RETURNING balance_cents
+                    ), ins AS (
+                        INSERT INTO transactions (
+                            user_telegram_id, type, amount_cents, status, pix_key, mercado_pago_id,
+                            admin_notes, parent_transaction_id
+                        )
+                        SELECT %(user_telegram_id)s, %(type)s, %(amount_cents)s, %(status)s, %(pix_key)s, %(mercado_pago_id)s,
+                               %(admin_notes)s, %(parent_transaction_id)s
+                        FROM upd
+                        RETURNING id
+                    )
+                    SELECT ins.id, upd.balance_cents FROM ins, upd
+                """, params)
+                result = cursor.fetchone()
+                if result is None:
+                    logger.warning("⚠️ Tentativa de deixar saldo negativo (ou usuário inexistente) para %s.", telegram_id)
+                    return None
+
+                if not conn_ext: conn.commit()
+                transaction_id, new_balance_cents = result
+                logger.info("💰 Saldo de %s atualizado para %s centavos (Mudança: %+d). Transação %s (Tipo: %s) registrada.", telegram_id, new_balance_cents, change_cents, transaction_id, params['type'])
+                return transaction_id, new_balance_cents
+        except psycopg2.Error as e:
+            logger.error("❌ Erro ao aplicar mudança de saldo para %s: %s", telegram_id, e, exc_info=True)
+            if conn_ext is None and not conn.closed: conn.rollback()
+            return None
 
 def update_transaction_status(transaction_id, new_status, **kwargs):
     """Atualiza o status e outros campos de uma transação."""
-    # <<< 1. FIX: Apply the same logic here.
-    is_external_conn = 'conn_ext' in kwargs
-    conn = kwargs.pop('conn_ext') if is_external_conn else get_db_connection()
-
-    fields_to_update = ["status = %s", "updated_at = %s"]
-    values = [new_status, datetime.now()]
-    if 'mp_id' in kwargs:
-        fields_to_update.append("mercado_pago_id = %s")
-        values.append(kwargs['mp_id'])
-    if 'admin_notes' in kwargs:
-        fields_to_update.append("admin_notes = %s")
-        values.append(kwargs['admin_notes'])
-    values.append(transaction_id)
-    try:
-        with conn.cursor() as cursor:
-            sql = f"UPDATE transactions SET {', '.join(fields_to_update)} WHERE id = %s"
-            cursor.execute(sql, tuple(values))
-            
-            # <<< 2. FIX: Use the boolean flag here as well.
-            if not is_external_conn:
-                conn.commit()
+    # Com uma conexão externa (conn_ext), o commit fica a cargo do chamador.
+    ext_conn = kwargs.pop('conn_ext', None)
+    using_ext = ext_conn is not None
+    with _borrow_conn(ext_conn) as conn:
+
+        try:
+            with conn.cursor() as cursor:
+                # SQL fixo: campos opcionais não informados (None) mantêm o valor atual.
+                cursor.execute("""
+                    UPDATE transactions
+                    SET status = %s, updated_at = now(),
+                        mercado_pago_id = COALESCE(%s, mercado_pago_id),
+                        admin_notes = COALESCE(%s, admin_notes)
+                    WHERE id = %s
+                """, (new_status, kwargs.get('mp_id'), kwargs.get('admin_notes'), transaction_id))
                 
-        logger.info(f"🔄 Status da transação {transaction_id} atualizado para '{new_status}'.")
-        return True
-    except psycopg2.Error as e:
-        logger.error(f"❌ Erro ao atualizar status da transação {transaction_id}: {e}", exc_info=True)
-        if not is_external_conn and conn:
-            conn.rollback()
-        return False
-    finally:
-        if not is_external_conn and conn:
-            conn.close()
+                # <<< 2. FIX: Use the boolean flag here as well.
+                if not using_ext:
+                    conn.commit()
+                    
+            logger.info("🔄 Status da transação %s atualizado para '%s'.", transaction_id, new_status)
+            return True
+        except psycopg2.Error as e:
+            logger.error("❌ Erro ao atualizar status da transação %s: %s", transaction_id, e, exc_info=True)
+            if not using_ext and not conn.closed:
+                conn.rollback()
+            return False
 
 def record_transaction(**kwargs):
     """Registra uma nova transação no banco de dados."""
-    # <<< 1. FIX: Check for the external connection BEFORE removing it from kwargs.
-    is_external_conn = 'conn_ext' in kwargs
-    conn = kwargs.pop('conn_ext') if is_external_conn else get_db_connection()
-    
-    now = datetime.now()
+    # Com uma conexão externa (conn_ext), o commit fica a cargo do chamador.
+    ext_conn = kwargs.pop('conn_ext', None)
+    using_ext = ext_conn is not None
     kwargs.setdefault('pix_key', None); kwargs.setdefault('mercado_pago_id', None); kwargs.setdefault('admin_notes', None)
-    kwargs['created_at'] = now; kwargs['updated_at'] = now
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            columns = ', '.join(kwargs.keys())
-            placeholders = ', '.join(['%s'] * len(kwargs))
-            sql = f"INSERT INTO transactions ({columns}) VALUES ({placeholders}) RETURNING id"
-            cursor.execute(sql, tuple(kwargs.values()))
-            transaction_id = cursor.fetchone()['id']
-            
-            # <<< 2. FIX: Use the boolean flag to decide whether to commit.
-            if not is_external_conn:
-                conn.commit()
+    kwargs.setdefault('parent_transaction_id', None)
+    with _borrow_conn(ext_conn) as conn:
+        try:
+            with conn.cursor(cursor_factory=_TupleCursor) as cursor:
+                # SQL fixo (independe de quais campos foram informados), para que o
+                # PostgreSQL possa reaproveitar o plano da consulta.
+                cursor.execute("""
+                    INSERT INTO transactions (
+                        user_telegram_id, type, amount_cents, status, pix_key, mercado_pago_id,
+                        admin_notes, parent_transaction_id
+                    ) VALUES (
+                        %(user_telegram_id)s, %(type)s, %(amount_cents)s, %(status)s, %(pix_key)s, %(mercado_pago_id)s,
+                        %(admin_notes)s, %(parent_transaction_id)s
+                    ) RETURNING id
+                """, kwargs)
+                transaction_id = cursor.fetchone()[0]
                 
-            logger.info(f"📄 Transação {transaction_id} (Tipo: {kwargs['type']}) registrada para usuário {kwargs['user_telegram_id']}.")
-            return transaction_id
-    except psycopg2.Error as e:
-        logger.error(f"❌ Erro ao registrar transação para {kwargs.get('user_telegram_id')}: {e}", exc_info=True)
-        if not is_external_conn and conn:
-            conn.rollback()
-        return None
-    finally:
-        if not is_external_conn and conn:
-            conn.close()
+                # <<< 2. FIX: Use the boolean flag to decide whether to commit.
+                if not using_ext:
+                    conn.commit()
+                    
+                logger.info("📄 Transação %s (Tipo: %s) registrada para usuário %s.", transaction_id, kwargs['type'], kwargs['user_telegram_id'])
+                return transaction_id
+        except psycopg2.Error as e:
+            logger.error("❌ Erro ao registrar transação para %s: %s", kwargs.get('user_telegram_id'), e, exc_info=True)
+            if not using_ext and not conn.closed:
+                conn.rollback()
+            return None
 
 def get_transaction_details(transaction_id):
     """Busca todos os detalhes de uma transação pelo seu ID."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
                 cursor.execute("SELECT * FROM transactions WHERE id = %s", (transaction_id,))
                 return cursor.fetchone()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar detalhes da transação {transaction_id}: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar detalhes da transação %s: %s", transaction_id, e, exc_info=True)
                 return None
 
 def get_pending_withdrawals():
     """Retorna todas as transações de saque com status 'EM ANÁLISE'."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
                 cursor.execute("SELECT * FROM transactions WHERE type = 'WITHDRAWAL' AND status = %s", (config.STATUS_EM_ANALISE,))
                 return cursor.fetchall()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar saques pendentes: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar saques pendentes: %s", e, exc_info=True)
                 return []
 
 def calculate_profits():
     """
-    Calcula o lucro total somando as taxas de transações CONCLUÍDAS.
+    Retorna o lucro total (em centavos) com taxas de transações CONCLUÍDAS.
+    O total é mantido incrementalmente na tabela `profits` por um trigger (ver init_db):
     - Taxas de depósito são contadas diretamente.
-    - Taxas de saque são contadas apenas se o saque correspondente foi concluído.
+    - Taxas de saque são contadas apenas quando o saque correspondente é concluído.
     """
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    with db_conn() as conn:
+        with conn.cursor(cursor_factory=_TupleCursor) as cursor:
             try:
-                # Esta consulta SQL usa uma subconsulta para garantir que apenas as taxas
-                # de saques bem-sucedidos sejam incluídas no cálculo do lucro.
-                # É específica para PostgreSQL devido ao uso de SUBSTRING com expressão regular.
-                sql_query = """
-                    SELECT COALESCE(SUM(T1.amount), 0.00)
-                    FROM transactions T1
-                    WHERE T1.type = 'FEE' AND T1.status = %s AND (
-                        -- Sempre conta as taxas de depósito, pois são criadas no sucesso.
-                        T1.admin_notes LIKE 'Taxa de depósito%%'
-                        OR
-                        -- Só conta taxas de saque se o saque correspondente foi CONCLUÍDO.
-                        (
-                            T1.admin_notes LIKE 'Taxa referente ao saque ID %%'
-                            AND
-                            EXISTS (
-                                SELECT 1
-                                FROM transactions T2
-                                WHERE T2.type = 'WITHDRAWAL'
-                                  AND T2.status = %s
-                                  -- Extrai o ID da nota e converte para integer para a correspondência.
-                                  AND T2.id = CAST(substring(T1.admin_notes from '(\\d+)$') AS INTEGER)
-                            )
-                        )
-                    )
-                """
-                cursor.execute(sql_query, (config.STATUS_CONCLUIDO, config.STATUS_CONCLUIDO))
+                cursor.execute("SELECT total_cents FROM profits WHERE id = 1")
                 result = cursor.fetchone()
-                # Retorna o resultado da soma. Se não houver, retorna 0.00.
-                return result[0] if result and result[0] is not None else 0.00
+                return result[0] if result else 0
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao calcular lucro: {e}", exc_info=True)
-                return 0.00
+                logger.error("❌ Erro ao calcular lucro: %s", e, exc_info=True)
+                return 0
 
 def get_fee_for_withdrawal(withdrawal_transaction_id):
-    """Busca o valor da taxa associada a uma transação de saque."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    """Busca o valor (em centavos) da taxa associada a uma transação de saque."""
+    with db_conn() as conn:
+        with conn.cursor(cursor_factory=_TupleCursor) as cursor:
             try:
-                note = f"Taxa referente ao saque ID {withdrawal_transaction_id}"
-                cursor.execute("SELECT amount FROM transactions WHERE type = 'FEE' AND admin_notes = %s", (note,))
+                cursor.execute("SELECT amount_cents FROM transactions WHERE type = 'FEE' AND parent_transaction_id = %s", (withdrawal_transaction_id,))
                 result = cursor.fetchone()
-                return result['amount'] if result else 0.00
+                return result[0] if result else 0
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar taxa para o saque {withdrawal_transaction_id}: {e}", exc_info=True)
-                return 0.00
+                logger.error("❌ Erro ao buscar taxa para o saque %s: %s", withdrawal_transaction_id, e, exc_info=True)
+                return 0
+
+# Cache curto de get_user_info: nome e username mudam raramente, e a consulta se repete
+# muito dentro de uma mesma conversa. Só guarda telegram_id, username e first_name; o
+# saldo nunca passa por aqui e deve ser lido sempre com get_balance.
+_USER_INFO_CACHE = TTLCache(maxsize=10000, ttl=60)
+_USER_INFO_CACHE_LOCK = threading.Lock()
 
 def get_user_info(telegram_id):
-    """Busca informações básicas de um usuário."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+    """Busca id, username e nome de um usuário (com cache de curta duração, sem o saldo)."""
+    with _USER_INFO_CACHE_LOCK:
+        user_info = _USER_INFO_CACHE.get(telegram_id)
+    if user_info is not None:
+        return user_info
+
+    user_info = _fetch_user_info(telegram_id)
+    if user_info is not None:
+        with _USER_INFO_CACHE_LOCK:
+            _USER_INFO_CACHE[telegram_id] = user_info
+    return user_info
+
+def _fetch_user_info(telegram_id):
+    """Busca no banco as informações básicas de um usuário."""
+    with db_conn() as conn:
+        with conn.cursor() as cursor:
             try:
-                cursor.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+                _execute_prepared(cursor, 'get_user_info_stmt', (telegram_id,))
                 return cursor.fetchone()
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar info do usuário {telegram_id}: {e}", exc_info=True)
+                logger.error("❌ Erro ao buscar info do usuário %s: %s", telegram_id, e, exc_info=True)
                 return None
 
-def get_last_transaction_date(telegram_id):
-    """Busca a data da última transação atualizada de um usuário."""
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
+def get_wallet_summary(telegram_id):
+    """
+    Busca, em uma única consulta, o saldo e a data da última transação de um usuário.
+    Usada pelo comando /carteira.
+
+    Returns:
+        tuple: (saldo em centavos, data da última movimentação formatada ou mensagem equivalente).
+    """
+    with db_conn() as conn:
+        with conn.cursor(cursor_factory=_TupleCursor) as cursor:
             try:
-                cursor.execute("SELECT updated_at FROM transactions WHERE user_telegram_id = %s ORDER BY updated_at DESC LIMIT 1", (telegram_id,))
+                _execute_prepared(cursor, 'get_wallet_summary_stmt', (telegram_id,))
                 result = cursor.fetchone()
-                if result:
-                    return result['updated_at'].strftime('%d/%m/%Y %H:%M')
-                return "Nenhuma transação"
+                if not result:
+                    return 0, "Nenhuma transação"
+                balance_cents, last_update = result
+                return balance_cents, last_update.strftime('%d/%m/%Y %H:%M') if last_update else "Nenhuma transação"
             except psycopg2.Error as e:
-                logger.error(f"❌ Erro ao buscar última data de transação para {telegram_id}: {e}", exc_info=True)
-                return "Erro ao consultar"
+                logger.error("❌ Erro ao buscar resumo da carteira para %s: %s", telegram_id, e, exc_info=True)
+                return 0, "Erro ao consultar"
@@ -22,7 +22,7 @@ import adm
 # 📜 CONFIGURAÇÃO DE LOGGING
 # =============================================
 logging.basicConfig(
-    level=logging.INFO,
+    level=config.LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         RotatingFileHandler("flexypay.log", maxBytes=5*1024*1024, backupCount=3),
@@ -34,7 +34,28 @@ logger = logging.getLogger(__name__)
 # =============================================
 # 🚀 INICIALIZAÇÃO DO BOT
 # =============================================
-bot = telebot.TeleBot(config.TELEGRAM_BOT_TOKEN, parse_mode="Markdown")
+class FlexiPayBot(telebot.TeleBot):
+    """TeleBot que registra os usuários de cada lote de updates antes de despachá-los."""
+
+    def process_new_updates(self, updates):
+        # Um único INSERT para todos os autores do lote, em vez de um por handler.
+        # Roda na thread de polling, antes de qualquer handler, então os usuários
+        # já existem quando os comandos são processados.
+        users = {}
+        for update in updates:
+            event = update.message or update.edited_message or update.callback_query
+            user = event.from_user if event else None
+            if user:
+                users[user.id] = (user.id, user.username, user.first_name)
+        try:
+            database.create_users_if_not_exist(list(users.values()))
+        except Exception as e:
+            # Sem banco, os comandos que não dependem dele (menu, /taxa etc.) ainda
+            # precisam ser despachados, e o lote precisa ser confirmado ao Telegram.
+            logger.error(f"❌ Erro ao registrar os usuários do lote de updates: {e}", exc_info=True)
+        super().process_new_updates(updates)
+
+bot = FlexiPayBot(config.TELEGRAM_BOT_TOKEN, parse_mode="Markdown")
 adm.register_admin_handlers(bot)
 
 logger.info(f"✅ Iniciando {config.NOME_BOT}...")
@@ -62,6 +83,23 @@ def criar_menu_principal():
     markup.add(btn_verificar)
     return markup
 
+# Textos e teclados que não mudam entre envios são montados (e os teclados
+# serializados em JSON, formato aceito diretamente pelo telebot) uma única vez.
+MENU_PRINCIPAL_JSON = criar_menu_principal().to_json()
+SUPORTE_MARKUP_JSON = InlineKeyboardMarkup().add(
+    InlineKeyboardButton(text="🤖 Falar com o Suporte", url=config.BOT_SUPORTE)
+).to_json()
+TEXTO_TAXAS = (
+    "💰 *Taxas de Operação*\n\n"
+    "📥 *DEPÓSITO:*\n"
+    f"• *{config.TAXA_DEPOSITO_PERCENTUAL * 100:.1f}%* sobre o valor depositado.\n"
+    "_Ex: Ao depositar R$100, você recebe R$89 em saldo._\n\n"
+    "📤 *SAQUE:*\n"
+    f"• *{config.TAXA_SAQUE_PERCENTUAL * 100:.1f}%* sobre o valor a receber\n"
+    f"• *+ R$ {config.TAXA_SAQUE_FIXA:.2f}* fixos por transação."
+)
+TEXTO_CANAL = f"📢 *Canal Oficial {config.NOME_BOT}*\n\nAcesse e fique por dentro de todas as novidades:\n{config.CANAL_OFICIAL}"
+
 # =============================================
 # 🛠️ FUNÇÃO AUXILIAR PARA PROCESSAR PAGAMENTOS
 # =============================================
@@ -75,43 +113,40 @@ def processar_pagamento_aprovado(transaction):
         return False
 
     user_id = transaction['user_telegram_id']
-    valor_deposito = transaction['amount']
+    valor_deposito_cents = transaction['amount_cents']
     transaction_id = transaction['id']
 
-    # Lógica de taxa de depósito
-    taxa_deposito = valor_deposito * config.TAXA_DEPOSITO_PERCENTUAL
-    valor_liquido = valor_deposito - taxa_deposito
+    # Lógica de taxa de depósito (em centavos inteiros)
+    taxa_deposito_cents = round(valor_deposito_cents * config.TAXA_DEPOSITO_PERCENTUAL)
+    valor_liquido_cents = valor_deposito_cents - taxa_deposito_cents
 
     # Operação atômica para garantir consistência
-    conn_atomic = database.get_db_connection()
-    try:
-        # Credita o valor líquido na carteira do usuário
-        database.update_balance(user_id, valor_liquido, conn_ext=conn_atomic)
-        
-        # Registra a taxa para cálculo de lucro
-        database.record_transaction(
-            user_telegram_id=user_id, type="FEE", amount=taxa_deposito,
-            status=config.STATUS_CONCLUIDO,
-            admin_notes=f"Taxa de depósito referente à transação ID {transaction_id}",
-            conn_ext=conn_atomic
-        )
-        
-        # Atualiza o status da transação de depósito original para PAGO
-        database.update_transaction_status(transaction_id, config.STATUS_DEPOSITO_PAGO, conn_ext=conn_atomic)
-        
-        conn_atomic.commit()
-        logger.info(f"✅ Depósito ID {transaction_id} para user {user_id} APROVADO. Valor creditado: R${valor_liquido:.2f}")
+    with database.db_conn() as conn_atomic:
+        try:
+            # Credita o valor líquido na carteira do usuário e registra a taxa
+            # para cálculo de lucro, em uma única ida ao banco
+            fee_record = database.apply_balance_change(user_id, valor_liquido_cents, {
+                'type': "FEE", 'amount_cents': taxa_deposito_cents, 'status': config.STATUS_CONCLUIDO,
+                'admin_notes': f"Taxa de depósito referente à transação ID {transaction_id}",
+                'parent_transaction_id': transaction_id
+            }, conn_ext=conn_atomic)
+            if fee_record is None:
+                raise Exception("Falha ao creditar o saldo do depósito.")
+            
+            # Atualiza o status da transação de depósito original para PAGO
+            database.update_transaction_status(transaction_id, config.STATUS_DEPOSITO_PAGO, conn_ext=conn_atomic)
+            
+            conn_atomic.commit()
+            logger.warning(f"✅ Depósito ID {transaction_id} para user {user_id} APROVADO. Valor creditado: R${valor_liquido_cents / 100:.2f}")
 
-        # Notifica o usuário
-        bot.send_message(user_id, f"✅ Seu depósito de R$ {valor_deposito:.2f} foi confirmado com sucesso!\n\n+ *R$ {valor_liquido:.2f}* foram adicionados à sua carteira.\nID da Transação: `{transaction_id}`")
-        return True
+            # Notifica o usuário
+            bot.send_message(user_id, f"✅ Seu depósito de R$ {valor_deposito_cents / 100:.2f} foi confirmado com sucesso!\n\n+ *R$ {valor_liquido_cents / 100:.2f}* foram adicionados à sua carteira.\nID da Transação: `{transaction_id}`")
+            return True
 
-    except Exception as e:
-        if conn_atomic: conn_atomic.rollback()
-        logger.critical(f"🆘 FALHA CRÍTICA ao processar depósito para ID {transaction_id}: {e}")
-        return False
-    finally:
-        if conn_atomic: conn_atomic.close()
+        except Exception as e:
+            conn_atomic.rollback()
+            logger.critical(f"🆘 FALHA CRÍTICA ao processar depósito para ID {transaction_id}: {e}")
+            return False
 
 # =============================================
 # 🤖 LÓGICA DO VERIFICADOR AUTOMÁTICO
@@ -146,14 +181,13 @@ def verificador_pix_periodico():
 def handle_start(message):
     user = message.from_user
     logger.info(f"👋 Usuário {user.id} ('{user.first_name}') iniciou o bot.")
-    database.create_user_if_not_exists(user.id, user.username, user.first_name)
-    saldo = database.get_balance(user.id)
+    saldo_cents = database.get_balance(user.id)
     welcome_text = (
         f"Olá, *{user.first_name}*!\n"
-        f"Seu saldo atual é de *R$ {saldo:.2f}*.\n\n"
+        f"Seu saldo atual é de *R$ {saldo_cents / 100:.2f}*.\n\n"
         f"👇 Escolha uma opção abaixo para começar:"
     )
-    bot.reply_to(message, welcome_text, reply_markup=criar_menu_principal())
+    bot.reply_to(message, welcome_text, reply_markup=MENU_PRINCIPAL_JSON)
 
 # <<< NOVO COMANDO >>>
 @bot.message_handler(commands=['verificar'])
@@ -234,16 +268,14 @@ def handle_carteira(message, from_button=False):
     user = message.from_user
     if not from_button: logger.info(f"👤 Usuário {user.id} consultou a carteira via comando.")
     
-    database.create_user_if_not_exists(user.id, user.username, user.first_name)
-    saldo = database.get_balance(user.id)
-    last_update = database.get_last_transaction_date(user.id)
+    saldo_cents, last_update = database.get_wallet_summary(user.id)
     
     response = (
         f"💼 *Sua Carteira {config.NOME_BOT}*\n\n"
         f"👤 Titular: {user.first_name}\n"
         f"🆔 ID: `{user.id}`\n\n"
         f"💰 *Saldo Disponível:*\n"
-        f"   *R$ {saldo:.2f}*\n\n"
+        f"   *R$ {saldo_cents / 100:.2f}*\n\n"
         f"📅 Última movimentação: {last_update}"
     )
     bot.send_message(message.chat.id, response)
@@ -293,7 +325,7 @@ def handle_pix_deposit(message, from_button=False):
 
         # Grava a transação no banco de dados com status pendente
         transaction_id = database.record_transaction(
-            user_telegram_id=user.id, type="DEPOSIT", amount=valor,
+            user_telegram_id=user.id, type="DEPOSIT", amount_cents=round(valor * 100),
             status=config.STATUS_DEPOSITO_PENDENTE,
             mercado_pago_id=str(pix_data['payment_id'])
         )
@@ -327,7 +359,6 @@ def handle_saque(message):
     """Processa uma solicitação de saque."""
     user = message.from_user
     logger.info(f"💸 Usuário {user.id} iniciou uma solicitação de saque.")
-    database.create_user_if_not_exists(user.id, user.username, user.first_name)
 
     parts = message.text.split()
     if len(parts) < 3:
@@ -337,60 +368,61 @@ def handle_saque(message):
     chave_pix = parts[1]
     
     try:
-        valor_total_debito = float(parts[2].replace(',', '.'))
-        if valor_total_debito <= config.TAXA_SAQUE_FIXA:
+        valor_total_debito_cents = round(float(parts[2].replace(',', '.')) * 100)
+        taxa_fixa_cents = round(config.TAXA_SAQUE_FIXA * 100)
+        if valor_total_debito_cents <= taxa_fixa_cents:
             bot.reply_to(message, f"❌ O valor a debitar deve ser maior que a taxa fixa de R$ {config.TAXA_SAQUE_FIXA:.2f}.")
             return
 
-        valor_a_receber = round((valor_total_debito - config.TAXA_SAQUE_FIXA) / (1 + config.TAXA_SAQUE_PERCENTUAL), 2)
+        valor_a_receber_cents = round((valor_total_debito_cents - taxa_fixa_cents) / (1 + config.TAXA_SAQUE_PERCENTUAL))
         
         # <<< NEW: Minimum withdrawal validation >>>
-        if valor_a_receber < config.LIMITE_MINIMO_SAQUE:
+        if valor_a_receber_cents < round(config.LIMITE_MINIMO_SAQUE * 100):
             bot.reply_to(message, f"❌ *Valor Mínimo Não Atingido!*\nO valor líquido a receber deve ser de pelo menos *R$ {config.LIMITE_MINIMO_SAQUE:.2f}*.")
             return
         
-        taxa_final = round(valor_total_debito - valor_a_receber, 2)
-        saldo_atual = database.get_balance(user.id)
+        taxa_final_cents = valor_total_debito_cents - valor_a_receber_cents
+        saldo_atual_cents = database.get_balance(user.id)
 
-        if saldo_atual < valor_total_debito:
-            bot.reply_to(message, f"❌ *Saldo insuficiente.*\nSeu saldo: *R$ {saldo_atual:.2f}* | Necessário: *R$ {valor_total_debito:.2f}*")
+        if saldo_atual_cents < valor_total_debito_cents:
+            bot.reply_to(message, f"❌ *Saldo insuficiente.*\nSeu saldo: *R$ {saldo_atual_cents / 100:.2f}* | Necessário: *R$ {valor_total_debito_cents / 100:.2f}*")
             return
 
-        conn = database.get_db_connection()
-        try:
-            # The transaction starts automatically with this first database call
-            if not database.update_balance(user.id, -valor_total_debito, conn_ext=conn):
-                 # This handles the case where the balance would go negative, which should be caught earlier, but is a good safeguard.
-                 raise Exception("Falha ao atualizar o saldo, possivelmente resultando em saldo negativo.")
-
-            transaction_id = database.record_transaction(
-                conn_ext=conn, user_telegram_id=user.id, type="WITHDRAWAL",
-                amount=valor_a_receber, status=config.STATUS_EM_ANALISE, pix_key=chave_pix
-            )
-            database.record_transaction(
-                conn_ext=conn, user_telegram_id=user.id, type="FEE",
-                amount=taxa_final, status=config.STATUS_CONCLUIDO,
-                admin_notes=f"Taxa referente ao saque ID {transaction_id}"
-            )
+        with database.db_conn() as conn:
+            try:
+                # Debita o saldo e registra o saque na mesma instrução
+                withdrawal = database.apply_balance_change(user.id, -valor_total_debito_cents, {
+                    'type': "WITHDRAWAL", 'amount_cents': valor_a_receber_cents,
+                    'status': config.STATUS_EM_ANALISE, 'pix_key': chave_pix
+                }, conn_ext=conn)
+                if withdrawal is None:
+                     # This handles the case where the balance would go negative, which should be caught earlier, but is a good safeguard.
+                     raise Exception("Falha ao atualizar o saldo, possivelmente resultando em saldo negativo.")
+                transaction_id, _ = withdrawal
+
+                database.record_transaction(
+                    conn_ext=conn, user_telegram_id=user.id, type="FEE",
+                    amount_cents=taxa_final_cents, status=config.STATUS_CONCLUIDO,
+                    admin_notes=f"Taxa referente ao saque ID {transaction_id}",
+                    parent_transaction_id=transaction_id
+                )
             
-            conn.commit()
+                conn.commit()
             
-            adm.notify_admin_of_withdrawal_request(transaction_id, user.id, user.first_name, valor_a_receber, chave_pix)
-            bot.reply_to(message,
-                         f"✅ *Solicitação de saque enviada!*\n\n"
-                         f"➖ Débito total: *R$ {valor_total_debito:.2f}*\n"
-                         f"💸 Você receberá: *R$ {valor_a_receber:.2f}*\n"
-                         f"📋 Taxa: R$ {taxa_final:.2f}\n\n"
-                         f"🔑 Chave PIX: `{chave_pix}`\n"
-                         f"🆔 ID: `{transaction_id}`")
-        except Exception as e_atomic:
-            if conn: conn.rollback()
-            logger.critical(f"💥 Erro atômico no /sacar para {user.id}: {e_atomic}", exc_info=True)
-            bot.reply_to(message, "❌ Erro crítico ao registrar sua solicitação. Nenhum valor foi debitado.")
-        finally:
-            if conn: conn.close()
+                adm.notify_admin_of_withdrawal_request(transaction_id, user.id, user.first_name, valor_a_receber_cents / 100, chave_pix)
+                bot.reply_to(message,
+                             f"✅ *Solicitação de saque enviada!*\n\n"
+                             f"➖ Débito total: *R$ {valor_total_debito_cents / 100:.2f}*\n"
+                             f"💸 Você receberá: *R$ {valor_a_receber_cents / 100:.2f}*\n"
+                             f"📋 Taxa: R$ {taxa_final_cents / 100:.2f}\n\n"
+                             f"🔑 Chave PIX: `{chave_pix}`\n"
+                             f"🆔 ID: `{transaction_id}`")
+            except Exception as e_atomic:
+                conn.rollback()
+                logger.critical(f"💥 Erro atômico no /sacar para {user.id}: {e_atomic}", exc_info=True)
+                bot.reply_to(message, "❌ Erro crítico ao registrar sua solicitação. Nenhum valor foi debitado.")
             
-    except ValueError:
+    except (ValueError, OverflowError):
         bot.reply_to(message, "❌ Valor inválido. Ex: `/sacar chave@pix.com 100`")
     except Exception as e:
         logger.error(f"💥 Erro inesperado no /sacar para {user.id}: {e}", exc_info=True)
@@ -400,40 +432,32 @@ def handle_saque(message):
 def handle_taxa(message, from_button=False):
     """Exibe as taxas de operação de forma clara para o usuário."""
     if not from_button: logger.info(f"💰 Usuário {message.from_user.id} consultou as taxas.")
-    texto_taxas = (
-        "💰 *Taxas de Operação*\n\n"
-        "📥 *DEPÓSITO:*\n"
-        f"• *{config.TAXA_DEPOSITO_PERCENTUAL * 100:.1f}%* sobre o valor depositado.\n"
-        "_Ex: Ao depositar R$100, você recebe R$89 em saldo._\n\n"
-        "📤 *SAQUE:*\n"
-        f"• *{config.TAXA_SAQUE_PERCENTUAL * 100:.1f}%* sobre o valor a receber\n"
-        f"• *+ R$ {config.TAXA_SAQUE_FIXA:.2f}* fixos por transação."
-    )
-    bot.send_message(message.chat.id, texto_taxas)
+    bot.send_message(message.chat.id, TEXTO_TAXAS)
 
 @bot.message_handler(commands=['suporte'])
 def handle_suporte(message, from_button=False):
     """Fornece os canais de suporte ao usuário."""
     if not from_button: logger.info(f"🆘 Usuário {message.from_user.id} solicitou suporte.")
-    markup = InlineKeyboardMarkup().add(InlineKeyboardButton(text="🤖 Falar com o Suporte", url=config.BOT_SUPORTE))
     support_msg = (
         f"🛎️ *Suporte {config.NOME_BOT}*\n\n"
         f"Clique no botão para falar com nossa equipe.\n"
         f"Seu ID de usuário: `{message.from_user.id}`"
     )
-    bot.send_message(message.chat.id, support_msg, reply_markup=markup, disable_web_page_preview=True)
+    bot.send_message(message.chat.id, support_msg, reply_markup=SUPORTE_MARKUP_JSON, disable_web_page_preview=True)
 
 @bot.message_handler(commands=['canal'])
 def handle_canal(message, from_button=False):
     """Envia o link do canal oficial."""
     if not from_button: logger.info(f"📢 Usuário {message.from_user.id} pediu o link do canal.")
-    channel_msg = f"📢 *Canal Oficial {config.NOME_BOT}*\n\nAcesse e fique por dentro de todas as novidades:\n{config.CANAL_OFICIAL}"
-    bot.send_message(message.chat.id, channel_msg, disable_web_page_preview=True)
+    bot.send_message(message.chat.id, TEXTO_CANAL, disable_web_page_preview=True)
 
 # =============================================
 # ▶️ INICIAR O BOT E O VERIFICADOR
 # =============================================
 if __name__ == '__main__':
+    # Garante que as tabelas, migrações e índices existam antes de atender usuários
+    database.init_db()
+
     # Inicia o verificador periódico em uma thread separada
     checker_thread = threading.Thread(target=verificador_pix_periodico, daemon=True)
     checker_thread.start()
@@ -6,7 +6,7 @@ import config
 import database
 import pay
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -33,13 +33,12 @@ def mercadopago_webhook():
             mp_id_str = str(payment_details.get("id"))
 
             # <<< ALTERAÇÃO: Trocando '?' por '%s' na consulta >>>
-            conn = database.get_db_connection()
-            # Usando DictCursor para acessar colunas por nome
-            cursor = conn.cursor(cursor_factory=database.DictCursor)
-            cursor.execute("SELECT * FROM transactions WHERE mercado_pago_id = %s AND status = %s", 
-                           (mp_id_str, config.STATUS_DEPOSITO_PENDENTE))
-            transaction = cursor.fetchone()
-            conn.close()
+            with database.db_conn() as conn:
+                # As conexões do pool já usam DictCursor (acesso às colunas por nome)
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT * FROM transactions WHERE mercado_pago_id = %s AND status = %s", 
+                                   (mp_id_str, config.STATUS_DEPOSITO_PENDENTE))
+                    transaction = cursor.fetchone()
 
             if not transaction:
                 logger.warning(f"Transação PENDENTE não encontrada para o MP ID: {mp_id_str}.")
@@ -47,33 +46,31 @@ def mercadopago_webhook():
 
             if status_mp == "approved":
                 user_id = transaction['user_telegram_id']
-                valor_deposito = transaction['amount']
+                valor_deposito_cents = transaction['amount_cents']
 
-                if float(valor_pago) != float(valor_deposito):
-                    logger.error(f"Divergência de valor para MP ID {mp_id_str}! Esperado: {valor_deposito}, Pago: {valor_pago}")
-                    database.update_transaction_status(transaction['id'], "ERRO_DIVERGENCIA", admin_notes=f"Esperado R${valor_deposito}, pago R${valor_pago}")
+                if round(float(valor_pago) * 100) != valor_deposito_cents:
+                    logger.error(f"Divergência de valor para MP ID {mp_id_str}! Esperado: {valor_deposito_cents / 100:.2f}, Pago: {valor_pago}")
+                    database.update_transaction_status(transaction['id'], "ERRO_DIVERGENCIA", admin_notes=f"Esperado R${valor_deposito_cents / 100:.2f}, pago R${valor_pago}")
                     return jsonify({"status": "error", "message": "Amount mismatch"}), 400
 
-                taxa_deposito = valor_deposito * config.TAXA_DEPOSITO_PERCENTUAL
-                valor_liquido = valor_deposito - taxa_deposito
+                taxa_deposito_cents = round(valor_deposito_cents * config.TAXA_DEPOSITO_PERCENTUAL)
+                valor_liquido_cents = valor_deposito_cents - taxa_deposito_cents
 
-                conn_atomic = database.get_db_connection()
-                try:
-                    database.update_balance(user_id, valor_liquido, conn_ext=conn_atomic)
-                    database.record_transaction(
-                        user_telegram_id=user_id, type="FEE", amount=taxa_deposito,
-                        status=config.STATUS_CONCLUIDO,
-                        admin_notes=f"Taxa de depósito referente à transação ID {transaction['id']}",
-                        conn_ext=conn_atomic
-                    )
-                    database.update_transaction_status(transaction['id'], config.STATUS_DEPOSITO_PAGO, conn_ext=conn_atomic)
-                    conn_atomic.commit()
-                    logger.info(f"Depósito ID {transaction['id']} para user {user_id} APROVADO. Valor creditado: R${valor_liquido:.2f}")
-                except Exception as e:
-                    if conn_atomic: conn_atomic.rollback()
-                    logger.critical(f"FALHA CRÍTICA ao processar depósito para MP ID {mp_id_str}: {e}")
-                finally:
-                    if conn_atomic: conn_atomic.close()
+                with database.db_conn() as conn_atomic:
+                    try:
+                        fee_record = database.apply_balance_change(user_id, valor_liquido_cents, {
+                            'type': "FEE", 'amount_cents': taxa_deposito_cents, 'status': config.STATUS_CONCLUIDO,
+                            'admin_notes': f"Taxa de depósito referente à transação ID {transaction['id']}",
+                            'parent_transaction_id': transaction['id']
+                        }, conn_ext=conn_atomic)
+                        if fee_record is None:
+                            raise Exception("Falha ao creditar o saldo do depósito.")
+                        database.update_transaction_status(transaction['id'], config.STATUS_DEPOSITO_PAGO, conn_ext=conn_atomic)
+                        conn_atomic.commit()
+                        logger.warning(f"Depósito ID {transaction['id']} para user {user_id} APROVADO. Valor creditado: R${valor_liquido_cents / 100:.2f}")
+                    except Exception as e:
+                        conn_atomic.rollback()
+                        logger.critical(f"FALHA CRÍTICA ao processar depósito para MP ID {mp_id_str}: {e}")
             else:
                 logger.info(f"Pagamento MP ID {mp_id_str} não foi aprovado. Status: {status_mp}")
                 database.update_transaction_status(transaction['id'], status_mp.upper())